@@ -1,54 +1,138 @@
 # -*- coding: utf-8 -*-
-import json
 import arxiv
+import atexit
 import datetime
+import feedparser
+import httpx
 import logging
-from typing import List, Dict, Any
+import operator
+import orjson
+from pathlib import Path
+from typing import Iterator, List, Dict, Any
 
 # 匯入重構後的設定模組
-from config import settings
+from config import get_settings
+
+# arXiv 每日新論文 RSS 來源，單次請求即可取得當日公告的全部論文
+ARXIV_RSS_URL = "https://rss.arxiv.org/rss/{category}"
+
+# 整個程序共用的 arXiv / HTTP 客戶端，重用連線與 TLS session
+_ARXIV_CLIENT = arxiv.Client(page_size=100, delay_seconds=3, num_retries=3)
+_HTTP = httpx.Client(http2=True, timeout=30.0)
+atexit.register(_HTTP.close)
+
+# 一次取出 arxiv.Result 上所有需要的屬性，避免在迴圈內逐一查找
+_RESULT_FIELDS = operator.attrgetter(
+    'get_short_id', 'updated', 'title', 'authors', 'primary_category', 'entry_id', 'pdf_url', 'summary'
+)
 
 def json_default(o: Any) -> Any:
-    """自訂 JSON 序列化程式，用於處理預設無法序列化的物件。"""
-    if isinstance(o, (datetime.date, datetime.datetime)):
-        return o.isoformat()
+    """
+    自訂 JSON 序列化程式，用於處理 orjson 預設無法序列化的物件。
+    datetime 由 orjson 原生處理 (且搜尋結果中的日期已是 ISO 字串)，此處僅需處理帶有 __dict__ 的物件。
+    """
     if hasattr(o, '__dict__'):
         return o.__dict__
     raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
 
-def search_latest_ai_paper(query: str, max_results: int) -> List[Dict[str, Any]]:
+def _search_via_rss(category: str, max_results: int) -> List[Dict[str, Any]]:
     """
-    從 arXiv 搜尋最新的論文。
+    透過單次 HTTP 請求從 arXiv RSS 取得指定分類當日公告的新論文。
 
     Args:
-        query (str): arXiv 搜尋查詢字串。
+        category (str): arXiv 分類，例如 "cs.AI"。
         max_results (int): 要獲取的最大結果數量。
 
     Returns:
-        List[Dict[str, Any]]: 包含論文資訊的字典列表。
+        List[Dict[str, Any]]: 包含論文資訊的字典列表，格式與 Search API 相同。
+    """
+    response = _HTTP.get(ARXIV_RSS_URL.format(category=category))
+    response.raise_for_status()
+    feed = feedparser.parse(response.content)
+
+    results_list: List[Dict[str, Any]] = []
+    for entry in feed.entries:
+        # 只保留新發表與跨領域的論文，略過舊論文的版本更新公告
+        if entry.get("arxiv_announce_type", "new") not in ("new", "cross"):
+            continue
+
+        # entry.id 格式: oai:arXiv.org:2501.01234v1，與 Search API 的 short id 一致
+        arxiv_id: str = entry.id.rsplit(':', 1)[-1]
+        paper_info: Dict[str, Any] = {
+            "arxiv_id": arxiv_id,
+            "updated": datetime.datetime(*entry.published_parsed[:6], tzinfo=datetime.timezone.utc).isoformat(),
+            "title": entry.title,
+            "authors": [name.strip() for name in entry.get("author", "").split(',') if name.strip()],
+            "category": entry.tags[0].term if entry.get("tags") else category,
+            "arxiv_url": f"http://arxiv.org/abs/{arxiv_id}",
+            "pdf_url": f"http://arxiv.org/pdf/{arxiv_id}",
+            # 摘要前綴為 "arXiv:xxxx Announce Type: new Abstract: ..."
+            "summary": entry.summary.split("Abstract:", 1)[-1].strip(),
+        }
+        results_list.append(paper_info)
+        if len(results_list) >= max_results:
+            break
+
+    return results_list
+
+def _search_via_api(query: str, max_results: int) -> Iterator[Dict[str, Any]]:
+    """
+    透過 arXiv Search API 搜尋最新的論文，逐篇產生結果。
+
+    由於是生成器，呼叫端停止迭代後共用的 arxiv.Client 就不會再請求下一頁。
+
+    Args:
+        query (str): arXiv 搜尋查詢字串。
+        max_results (int): 要獲取的最大結果數量。
+
+    Yields:
+        Dict[str, Any]: 單篇論文資訊的字典。
     """
-    client = arxiv.Client()
     search = arxiv.Search(
         query=query,
         max_results=max_results,
         sort_by=arxiv.SortCriterion.SubmittedDate
     )
 
-    results_list = []
-    for result in client.results(search):
-        paper_info = {
-            "arxiv_id": result.get_short_id(),
-            "updated": result.updated,
-            "title": result.title,
-            "authors": [author.name for author in result.authors],
-            "category": result.primary_category,
-            "arxiv_url": result.entry_id,
-            "pdf_url": result.pdf_url,
-            "summary": result.summary
+    for get_short_id, updated, title, authors, category, entry_id, pdf_url, summary in map(
+        _RESULT_FIELDS, _ARXIV_CLIENT.results(search)
+    ):
+        yield {
+            "arxiv_id": get_short_id(),
+            "updated": updated.isoformat(),
+            "title": title,
+            "authors": [author.name for author in authors],
+            "category": category,
+            "arxiv_url": entry_id,
+            "pdf_url": pdf_url,
+            "summary": summary
         }
-        results_list.append(paper_info)
-    
-    return results_list
+
+def search_latest_ai_paper(query: str, max_results: int) -> Iterator[Dict[str, Any]]:
+    """
+    從 arXiv 搜尋最新的論文，逐篇產生結果。
+
+    若查詢為單一分類 (例如 "cat:cs.AI")，優先使用 RSS 以單次請求取得當日新論文；
+    RSS 無結果 (例如週末沒有公告) 或查詢較複雜時，改用分頁的 Search API。
+
+    Args:
+        query (str): arXiv 搜尋查詢字串。
+        max_results (int): 要獲取的最大結果數量。
+
+    Yields:
+        Dict[str, Any]: 單篇論文資訊的字典。
+    """
+    if query.startswith("cat:") and " " not in query:
+        try:
+            results_list = _search_via_rss(query.split(':', 1)[1], max_results)
+            if results_list:
+                yield from results_list
+                return
+            logging.info("RSS 今日沒有新論文，改用 Search API 搜尋。")
+        except Exception as e:
+            logging.warning("從 RSS 取得論文失敗，改用 Search API 搜尋: %s", e)
+
+    yield from _search_via_api(query, max_results)
 
 def save_results_to_json(results: List[Dict[str, Any]], filename: str = "arxiv_search.json"):
     """
@@ -58,19 +142,24 @@ def save_results_to_json(results: List[Dict[str, Any]], filename: str = "arxiv_s
         results (List[Dict[str, Any]]): 要儲存的搜尋結果。
         filename (str): 儲存結果的檔名。
     """
-    with open(filename, "w", encoding='utf-8') as f:
-        json.dump(results, f, default=json_default, indent=4, ensure_ascii=False)
-    logging.info(f"成功將 {len(results)} 筆結果儲存到 {filename}")
+    # orjson 直接輸出 UTF-8 bytes；日期在搜尋時已轉為 ISO 字串
+    Path(filename).write_bytes(orjson.dumps(
+        results,
+        default=json_default,
+        option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+    ))
+    logging.info("成功將 %s 筆結果儲存到 %s", len(results), filename)
 
 if __name__ == "__main__":
     # 為了讓這個腳本可以獨立執行時也能看到日誌，我們在此處進行基本設定
     logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
     
     logging.info("正在搜尋最新的 AI 論文 (獨立執行測試)...")
-    latest_papers = search_latest_ai_paper(
+    settings = get_settings()
+    latest_papers = list(search_latest_ai_paper(
         query=settings.ARXIV_QUERY,
         max_results=settings.ARXIV_MAX_RESULTS
-    )
+    ))
     
     if latest_papers:
         save_results_to_json(latest_papers)
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 import os
+from functools import lru_cache
+from typing import Literal
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class Settings(BaseSettings):
@@ -13,6 +15,8 @@ class Settings(BaseSettings):
     SUPABASE_URL: str
     SUPABASE_KEY: str
     SUPABASE_BUCKET_NAME: str = "audios"
+    # 是否在本地直接組出 Storage 公開 URL (適用於公開 bucket)，設為 False 則改用 SDK 的 get_public_url
+    SUPABASE_LOCAL_PUBLIC_URL: bool = True
 
     # Gemini API 設定
     GEMINI_API_KEY: str
@@ -20,10 +24,39 @@ class Settings(BaseSettings):
     # Arxiv 搜尋設定
     ARXIV_QUERY: str = "cat:cs.AI"
     ARXIV_MAX_RESULTS: int = 5
+
+    # 每次執行最多處理的新論文數量，以及同時處理的論文數量上限
+    MAX_NEW_PAPERS_PER_RUN: int = 4
+    MAX_CONCURRENCY: int = 4
+    
+    # 用戶上傳論文同時處理的數量上限
+    UPLOAD_CONCURRENCY: int = 4
+
+    # 上傳的音檔格式：wav (預設) 或 ogg (Opus 32 kbps，檔案約小 10 倍，需安裝 av 套件，無法編碼時自動退回 wav)
+    AUDIO_FORMAT: Literal["wav", "ogg"] = "wav"
+
+    # 本地已處理論文 ID 快取 (SQLite)，GitHub Actions 透過 actions/cache 保留
+    SEEN_IDS_DB_PATH: str = ".cache/seen_ids.sqlite"
     
     # 輸出資料夾 (本地測試用)
     OUTPUT_BASE_FOLDER: str = "Podcast_output"
+    # 除錯模式：本地輸出的 JSON 改為縮排格式，方便人工閱讀
+    DEBUG: bool = False
 
 
-# 建立一個全域可用的設定實例
-settings = Settings() 
\ No newline at end of file
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """
+    建立並快取全域設定實例，第一次呼叫時才讀取 .env 並驗證欄位。
+    測試時可透過 get_settings.cache_clear() 重新載入。
+    """
+    return Settings()
+
+def __getattr__(name: str):
+    """
+    保留 `config.settings` 的存取方式；模組內的呼叫端一律在使用處呼叫 get_settings()，
+    避免在匯入時就建立設定實例。
+    """
+    if name == "settings":
+        return get_settings()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
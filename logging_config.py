@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
+import atexit
 import logging
+import logging.handlers
+import queue
 import sys
 
 def setup_logging():
@@ -7,6 +10,8 @@ def setup_logging():
     設定全域日誌記錄器。
     - 輸出格式包含時間、日誌級別、模組名稱和訊息。
     - 確保在不同環境（如 GitHub Actions）中能正確顯示。
+    - 工作執行緒只將日誌放入佇列，實際的格式化與 stdout 寫入交由背景的 QueueListener 處理，
+      避免多個並行處理論文的執行緒在 stdout 上互相等待。
     """
     logging.basicConfig(
         level=logging.INFO,
@@ -22,10 +27,16 @@ def setup_logging():
     if logger.hasHandlers():
         logger.handlers.clear()
 
-    # 重新加入我們設定的處理器
+    # 實際輸出到 stdout 的處理器，由背景的 QueueListener 呼叫
     handler = logging.StreamHandler(sys.stdout)
     formatter = logging.Formatter("%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s")
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
 
-    logging.info("日誌系統已成功設定。") 
\ No newline at end of file
+    # 根記錄器只加入 QueueHandler，程式結束時停止 listener 以確保佇列中的日誌都已輸出
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logging.info("日誌系統已成功設定。")
@@ -1,61 +1,62 @@
 # -*- coding: utf-8 -*-
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import batched
+from typing import Any, Dict, Optional
 
 # 匯入重構後的模組
-from config import settings
+from config import get_settings
 from logging_config import setup_logging
 from arxiv_search import search_latest_ai_paper
 from podcast_generater import PaperPodcastGenerator, PaperInfo
 from services.supabase_service import SupabaseService
-from utils.audio_utils import convert_pcm_to_wav_in_memory
 from utils.file_utils import save_output_locally
 
-def process_single_paper(
-    paper: dict,
-    supabase_service: SupabaseService,
+def generate_paper_podcast(
+    paper: Dict[str, Any],
     podcast_generator: PaperPodcastGenerator
+) -> Optional[Dict[str, Any]]:
+    """
+    管線第一階段：下載論文並以 Gemini 生成 Podcast 內容和音訊。
+    失敗時記錄錯誤並回傳 None，讓其他論文繼續處理。
+    """
+    arxiv_id: str = paper['arxiv_id']
+    logging.info("📄 開始處理新論文: %s (ID: %s)", paper['title'], arxiv_id)
+
+    try:
+        return podcast_generator.process_paper(pdf_url=paper['pdf_url'])
+    except Exception as e:
+        logging.error("處理論文 %s 時發生嚴重錯誤: %s", arxiv_id, e, exc_info=True)
+        return None
+
+def save_paper_podcast(
+    paper: Dict[str, Any],
+    podcast_result: Dict[str, Any],
+    supabase_service: SupabaseService
 ):
     """
-    處理單篇新論文的完整流程。
+    管線第二階段：將生成的 Podcast 音檔上傳到 Supabase 並寫入資料庫。
     """
-    arxiv_id = paper['arxiv_id']
-    pdf_url = paper['pdf_url']
-    logging.info(f"📄 開始處理新論文: {paper['title']} (ID: {arxiv_id})")
+    arxiv_id: str = paper['arxiv_id']
+    pdf_url: str = paper['pdf_url']
 
     try:
-        # 1. 生成 Podcast 內容和音訊
-        podcast_result = podcast_generator.process_paper(pdf_url=pdf_url)
         paper_info: PaperInfo = podcast_result['paper_info']
         script: str = podcast_result['script']
         audio_data: bytes = podcast_result['audio_data']
+        audio_ext: str = podcast_result['audio_ext']
         duration: float = podcast_result.get('duration_seconds', 0)
 
-        # 2. 將 raw PCM 音訊轉換為 WAV 格式
-        wav_data = convert_pcm_to_wav_in_memory(audio_data)
-
-        # 3. (可選) 儲存所有產出到本地，方便除錯
-        # 透過環境變數 SAVE_FILES_LOCALLY=true 來啟用
-        if os.getenv("SAVE_FILES_LOCALLY", "false").lower() == "true":
-            save_output_locally(
-                output_base_folder=settings.OUTPUT_BASE_FOLDER,
-                arxiv_id=arxiv_id,
-                paper_info=paper_info,
-                script=script,
-                wav_data=wav_data
-            )
-            
-        # 4. 上傳音檔到 Supabase Storage
-        logging.info("☁️ 正在上傳音檔到 Supabase Storage...")
-        audio_dest_path = f"{arxiv_id}.wav"
-        audio_url = supabase_service.upload_audio(audio_dest_path, wav_data)
-
-        # 5. 準備資料並寫入資料庫
-        db_record = {
+        # 1. 公開 URL 可直接由路徑決定，因此先組出 URL 並準備資料庫記錄
+        audio_dest_path: str = f"{arxiv_id}{audio_ext}"
+        audio_url: str = supabase_service.get_public_url(audio_dest_path)
+
+        db_record: Dict[str, Any] = {
             "arxiv_id": arxiv_id,
             "title": paper_info.title,
             "authors": paper.get('authors', []),
-            "publish_date": paper.get('updated').isoformat(),
+            "publish_date": paper.get('updated'),
             "summary": paper_info.abstract,
             "full_text": script,
             "category": paper.get('category'),
@@ -68,12 +69,29 @@ def process_single_paper(
             "audio_url": audio_url,
             "duration_seconds": round(duration),
         }
-        
-        supabase_service.insert_paper(db_record)
-        logging.info(f"🎉 成功處理並儲存論文: {paper_info.title}")
+
+        with ThreadPoolExecutor(max_workers=1) as disk_executor:
+            # 2. (可選) 在背景執行緒儲存所有產出到本地，方便除錯，磁碟寫入與上傳同時進行
+            # 透過環境變數 SAVE_FILES_LOCALLY=true 來啟用
+            if os.getenv("SAVE_FILES_LOCALLY", "false").lower() == "true":
+                disk_executor.submit(
+                    save_output_locally,
+                    output_base_folder=get_settings().OUTPUT_BASE_FOLDER,
+                    arxiv_id=arxiv_id,
+                    paper_info=paper_info,
+                    script=script,
+                    audio_data=audio_data,
+                    audio_ext=audio_ext
+                )
+
+            # 3. 在背景上傳音檔到 Supabase Storage，同時寫入資料庫，重疊兩段網路延遲
+            logging.info("☁️ 正在上傳音檔到 Supabase Storage 並寫入資料庫...")
+            supabase_service.upload_audio_and_insert(audio_dest_path, audio_data, db_record)
+
+        logging.info("🎉 成功處理並儲存論文: %s", paper_info.title)
 
     except Exception as e:
-        logging.error(f"處理論文 {arxiv_id} 時發生嚴重錯誤: {e}", exc_info=True)
+        logging.error("儲存論文 %s 時發生嚴重錯誤: %s", arxiv_id, e, exc_info=True)
         # 即使單篇論文失敗，也繼續處理下一篇
         pass
 
@@ -85,43 +103,67 @@ def main_workflow():
     setup_logging()
     logging.info("🚀 開始執行每日論文播客生成工作流程...")
     
+    podcast_generator = None
     try:
-        # 初始化服務
+        # 初始化服務 (第一次呼叫 get_settings 時才讀取 .env 並驗證設定)
+        settings = get_settings()
         supabase_service = SupabaseService(settings)
-        podcast_generator = PaperPodcastGenerator(settings.GEMINI_API_KEY)
+        podcast_generator = PaperPodcastGenerator(settings.GEMINI_API_KEY, audio_format=settings.AUDIO_FORMAT)
         
-        # 2. 搜尋最新的論文
+        # 2. 搜尋最新的論文 (生成器，按需逐篇取得)
         logging.info("\n🔍 正在從 arXiv 搜尋最新論文...")
         latest_papers = search_latest_ai_paper(
             query=settings.ARXIV_QUERY,
             max_results=settings.ARXIV_MAX_RESULTS
         )
-        if not latest_papers:
-            logging.info("沒有找到新的論文。工作流程結束。")
-            return
 
-        new_papers_found = 0
-        for paper in latest_papers:
-            arxiv_id = paper['arxiv_id']
-            
-            # 3. 檢查論文是否已存在
-            existing_title = supabase_service.check_paper_exists(arxiv_id)
-            if existing_title:
-                logging.info(f"✅ 論文 (ID: {arxiv_id}, 標題: {existing_title}) 已存在，跳過處理。")
-                continue
-            
-            new_papers_found += 1
-            process_single_paper(paper, supabase_service, podcast_generator)
-            
-            # 預設只處理一篇新論文，以避免超時
-            # 若要處理所有找到的新論文，可註解掉此行
-            break
+        # 3. 分批檢查論文是否已存在，湊滿所需的新論文數量後立即停止，
+        #    讓 arXiv 客戶端不必繼續抓取用不到的頁面
+        new_papers = []
+        for batch in batched(latest_papers, settings.MAX_NEW_PAPERS_PER_RUN):
+            existing_papers = supabase_service.check_papers_exist([p['arxiv_id'] for p in batch])
+            for paper in batch:
+                arxiv_id = paper['arxiv_id']
+                
+                if arxiv_id in existing_papers:
+                    logging.info("✅ 論文 (ID: %s, 標題: %s) 已存在，跳過處理。", arxiv_id, existing_papers[arxiv_id])
+                    continue
+                
+                new_papers.append(paper)
+
+            if len(new_papers) >= settings.MAX_NEW_PAPERS_PER_RUN:
+                break
         
-        if new_papers_found == 0:
-            logging.info("✅ 所有找到的論文都已處理過，本次無新論文。")
+        logging.info("📊 論文存在性快取統計: %s", supabase_service.existence_cache_info())
+
+        if not new_papers:
+            logging.info("✅ 沒有找到新的論文，或所有找到的論文都已處理過。工作流程結束。")
+            return
+
+        # 4. 以兩階段管線並行處理新論文：
+        #    生成階段 (下載 + Gemini) 與儲存階段 (上傳 + 寫入資料庫) 各自使用有上限的執行緒池，
+        #    一篇論文生成完畢後立即交給儲存階段，生成執行緒可以馬上開始處理下一篇，
+        #    讓上傳的網路延遲隱藏在下一篇論文的 TTS 生成之後
+        # 每次執行的論文數量受 MAX_NEW_PAPERS_PER_RUN 限制，以避免超時
+        new_papers = new_papers[:settings.MAX_NEW_PAPERS_PER_RUN]
+        logging.info("🧵 將以最多 %s 個執行緒並行處理 %s 篇新論文", settings.MAX_CONCURRENCY, len(new_papers))
+        with ThreadPoolExecutor(max_workers=settings.MAX_CONCURRENCY) as generate_executor, \
+                ThreadPoolExecutor(max_workers=settings.MAX_CONCURRENCY) as save_executor:
+            generate_futures = {
+                generate_executor.submit(generate_paper_podcast, paper, podcast_generator): paper
+                for paper in new_papers
+            }
+            for future in as_completed(generate_futures):
+                podcast_result = future.result()
+                if podcast_result is not None:
+                    save_executor.submit(save_paper_podcast, generate_futures[future], podcast_result, supabase_service)
 
     except Exception as e:
-        logging.critical(f"😭 工作流程執行失敗: {e}", exc_info=True)
+        logging.critical("😭 工作流程執行失敗: %s", e, exc_info=True)
+    finally:
+        # 所有執行緒池都已結束，可以安全關閉共用的 HTTP 客戶端
+        if podcast_generator is not None:
+            podcast_generator.close()
 
     logging.info("\n🏁 工作流程執行完畢。")
 
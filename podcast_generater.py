@@ -3,20 +3,22 @@
 論文播客生成器（結構化輸出版）
 使用 Gemini API 結構化輸出
 """
+import hashlib
 import logging
 import os
-import wave
-import json
+import tempfile
 import httpx
 from pathlib import Path
-from typing import List, Dict, Any
-from datetime import datetime
+from typing import List, Dict, Any, Optional
 from pydantic import BaseModel, Field
+from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 from google import genai
-from google.genai.client import Client
+from google.genai import errors as genai_errors
 from google.genai import types
 from google.genai.types import GenerateContentConfig, SpeechConfig, MultiSpeakerVoiceConfig, SpeakerVoiceConfig, VoiceConfig, PrebuiltVoiceConfig
 
+from utils.audio_utils import encode_pcm_audio
+
 # --- 模組內部常數設定 ---
 GEMINI_MODELS = {
     "info_extraction": "gemini-2.5-pro",
@@ -24,12 +26,24 @@ GEMINI_MODELS = {
     "tts": "gemini-2.5-pro-preview-tts",
 }
 
+# 本地快取資料夾：以 PDF 的 SHA-256 快取論文資訊，以提示詞的 SHA-256 快取逐字稿
+PAPER_INFO_CACHE_DIR = Path(".cache/paper_info")
+SCRIPT_CACHE_DIR = Path(".cache/script")
+
 PODCAST_SPEAKERS = {
     "speaker1": {"name": "林冠傑", "voice": "Charon"},
     "speaker2": {"name": "林欣潔", "voice": "Zephyr"},
 }
 # -------------------------
 
+def _is_retryable_error(exc: BaseException) -> bool:
+    """判斷錯誤是否為暫時性錯誤 (429 / 5xx / 網路錯誤)，驗證失敗等永久性 4xx 錯誤不重試"""
+    if isinstance(exc, genai_errors.APIError):
+        return exc.code == 429 or exc.code >= 500
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return isinstance(exc, httpx.TransportError)
+
 class PaperInfo(BaseModel):
     """論文資訊的結構化模型"""
     title: str = Field(description="論文標題的中文翻譯")
@@ -41,20 +55,34 @@ class PaperInfo(BaseModel):
     method: str = Field(description="研究方法簡述")
     results: str = Field(description="主要結果或發現")
 
-class PodcastScript(BaseModel):
-    """播客逐字稿的結構化模型"""
-    title: str = Field(description="播客節目標題")
-    speakers: List[str] = Field(description="主持人列表")
-    segments: List[dict] = Field(description="播客段落，包含speaker和content")
-    duration_estimate: str = Field(description="預估播放時間")
+# 論文資訊提取的提示詞與結構化輸出設定，於匯入時建立一次，避免每次呼叫重建
+INFO_EXTRACTION_PROMPT = """
+            請分析這篇學術論文，並用繁體中文提取以下關鍵資訊：
+            1. 將論文標題翻譯成繁體中文
+            2. 提取論文作者列表（保持原文名稱）
+            3. 將論文摘要翻譯成繁體中文，大約200-300字
+            4. 識別主要研究領域
+            5. 總結3-5個核心創新點或貢獻
+            6. 簡述研究方法
+            7. 概括主要結果或發現
+            8. 提供3-5個最相關的關鍵字標籤 (tags)
+            請確保所有內容都使用繁體中文，並且準確反映論文的核心內容。
+            """
+
+INFO_EXTRACTION_CONFIG = GenerateContentConfig(
+    response_mime_type="application/json",
+    response_schema=PaperInfo,
+)
 
 class PaperPodcastGenerator:
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, max_retries: int = 5, audio_format: str = "wav"):
         """
         初始化播客生成器
         
         Args:
             api_key (str): Gemini API 金鑰
+            max_retries (int): 遇到暫時性錯誤 (429 / 5xx) 時的最大嘗試次數
+            audio_format (str): 輸出的音檔格式，"wav" 或 "ogg" (Opus)
         """
         # Google Generative AI Python SDK in v0.5.0 has a bug
         # where it doesn't properly read the GEMEINI_API_KEY from the environment.
@@ -68,29 +96,104 @@ class PaperPodcastGenerator:
         self.speaker2 = PODCAST_SPEAKERS["speaker2"]["name"]
         self.speaker1_voice = PODCAST_SPEAKERS["speaker1"]["voice"]
         self.speaker2_voice = PODCAST_SPEAKERS["speaker2"]["voice"]
+
+        # 主持人固定，語音設定只需建立一次
+        self._tts_config = GenerateContentConfig(
+            response_modalities=["AUDIO"],
+            speech_config=SpeechConfig(
+                multi_speaker_voice_config=MultiSpeakerVoiceConfig(
+                    speaker_voice_configs=[
+                        SpeakerVoiceConfig(speaker=self.speaker1, voice_config=VoiceConfig(prebuilt_voice_config=PrebuiltVoiceConfig(voice_name=self.speaker1_voice))),
+                        SpeakerVoiceConfig(speaker=self.speaker2, voice_config=VoiceConfig(prebuilt_voice_config=PrebuiltVoiceConfig(voice_name=self.speaker2_voice))),
+                    ]
+                )
+            )
+        )
         
+        self.audio_format = audio_format
+
         # 檔案大小限制
         self.max_file_size = 100 * 1024 * 1024  # 100MB
 
-    def read_pdf_from_url(self, pdf_url: str) -> bytes:
-        """從URL讀取PDF內容"""
+        # 暫時性錯誤的重試設定 (指數退避 + 抖動)
+        self.max_retries = max_retries
+
+        # 跨論文共用的 HTTP 客戶端，重用連線並以 HTTP/2 多工處理並行下載
+        self._http = httpx.Client(
+            http2=True,
+            timeout=60.0,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=50)
+        )
+
+    def close(self):
+        """關閉共用的 HTTP 客戶端"""
+        self._http.close()
+
+    def _call_with_retry(self, func, *args, **kwargs):
+        """以指數退避重試呼叫 func，只重試暫時性錯誤，避免整條流程因單次 429/5xx 而重來"""
+        retrying = Retrying(
+            stop=stop_after_attempt(self.max_retries),
+            wait=wait_exponential_jitter(initial=2, max=60),
+            retry=retry_if_exception(_is_retryable_error),
+            before_sleep=lambda state: logging.warning(
+                "⚠️ 暫時性錯誤，第 %s 次重試: %s", state.attempt_number, state.outcome.exception()
+            ),
+            reraise=True,
+        )
+        return retrying(func, *args, **kwargs)
+
+    def _download_pdf(self, client: httpx.Client, url: str, headers: Optional[Dict[str, str]] = None) -> bytes:
+        """
+        以串流方式下載 PDF，並寫入依 Content-Length 預先配置的 bytearray，
+        避免 httpx 先緩衝所有區塊再合併成一份完整副本。
+        """
+        headers = dict(headers or {})
+        # arXiv 的 PDF 本身已經壓縮，要求原樣傳輸以省去一次解壓縮與額外的緩衝區
+        if httpx.URL(url).host.endswith("arxiv.org"):
+            headers["Accept-Encoding"] = "identity"
+        with client.stream("GET", url, headers=headers) as response:
+            # 將錯誤狀態碼轉為例外以便判斷是否重試
+            response.raise_for_status()
+
+            if 'pdf' not in response.headers.get('content-type', '').lower() and not url.lower().endswith('.pdf'):
+                logging.warning("警告: 內容類型可能不是PDF: %s", response.headers.get('content-type', ''))
+
+            # 在讀取內容前就以 Content-Length 拒絕過大的檔案
+            size = int(response.headers.get('content-length', 0))
+            if size > self.max_file_size:
+                raise ValueError(
+                    f"檔案太大: {size / 1024 / 1024:.2f}MB "
+                    f"(最大 {self.max_file_size / 1024 / 1024}MB)"
+                )
+
+            buffer = bytearray(size)
+            offset = 0
+            for chunk in response.iter_bytes(chunk_size=1 << 20):
+                # 第一個區塊就檢查 PDF 檔頭，無效的檔案最多只浪費一個區塊的傳輸量
+                if offset == 0 and not chunk.startswith(b'%PDF'):
+                    raise ValueError("下載的檔案不是有效的PDF格式")
+                end = offset + len(chunk)
+                # 未提供 (或提供錯誤的) Content-Length 時，在下載過程中持續檢查大小
+                if end > self.max_file_size:
+                    raise ValueError(f"檔案超過大小上限 {self.max_file_size / 1024 / 1024}MB，停止下載")
+                # 長度未知 (或與 Content-Length 不符) 時，切片賦值會自動擴充緩衝區
+                buffer[offset:end] = chunk
+                offset = end
+            if offset == 0:
+                raise ValueError("下載的檔案是空的")
+            del buffer[offset:]
+            # Part.from_bytes 只接受 bytes，傳入 bytearray 也會被複製一次；
+            # 在此轉換後下游可直接共用同一份資料，緩衝區則隨即釋放
+            return bytes(buffer)
+
+    def read_pdf_from_url(self, pdf_url: str, headers: Optional[Dict[str, str]] = None) -> bytes:
+        """從URL讀取PDF內容，headers 為額外的請求標頭 (例如受保護 Storage 的驗證資訊)"""
         try:
-            logging.info(f"正在下載PDF: {pdf_url}")
+            logging.info("正在下載PDF: %s", pdf_url)
             if not pdf_url.startswith(('http://', 'https://')):
                 raise ValueError(f"無效的URL格式: {pdf_url}")
             
-            with httpx.Client(timeout=60.0) as client:
-                response = client.get(pdf_url)
-                response.raise_for_status()
-                
-                if 'pdf' not in response.headers.get('content-type', '').lower() and not pdf_url.lower().endswith('.pdf'):
-                    logging.warning(f"警告: 內容類型可能不是PDF: {response.headers.get('content-type', '')}")
-                
-                pdf_data = response.content
-                if not pdf_data.startswith(b'%PDF'):
-                    raise ValueError("下載的檔案不是有效的PDF格式")
-                
-                return pdf_data
+            return self._call_with_retry(self._download_pdf, self._http, pdf_url, headers)
                 
         except Exception as e:
             raise Exception(f"下載PDF失敗: {str(e)}")
@@ -108,7 +211,7 @@ class PaperPodcastGenerator:
         try:
             pdf_path = Path(pdf_path).resolve()
             
-            logging.info(f"正在讀取檔案: {pdf_path}")
+            logging.info("正在讀取檔案: %s", pdf_path)
             
             if not pdf_path.exists():
                 current_dir = Path.cwd()
@@ -131,10 +234,10 @@ class PaperPodcastGenerator:
                     f"(最大 {self.max_file_size / 1024 / 1024}MB)"
                 )
             
-            logging.info(f"檔案大小: {file_size / 1024 / 1024:.2f}MB")
+            logging.info("檔案大小: %.2fMB", file_size / 1024 / 1024)
             
             if not pdf_path.suffix.lower() == '.pdf':
-                logging.warning(f"警告: 檔案擴展名不是.pdf: {pdf_path.suffix}")
+                logging.warning("警告: 檔案擴展名不是.pdf: %s", pdf_path.suffix)
             
             with open(pdf_path, 'rb') as f:
                 pdf_data = f.read()
@@ -142,7 +245,7 @@ class PaperPodcastGenerator:
             if not pdf_data.startswith(b'%PDF'):
                 raise ValueError("檔案不是有效的PDF格式")
             
-            logging.info(f"✅ 成功讀取PDF檔案，大小: {len(pdf_data):,} bytes")
+            logging.info("✅ 成功讀取PDF檔案，大小: %d bytes", len(pdf_data))
             return pdf_data
             
         except FileNotFoundError as e:
@@ -154,40 +257,55 @@ class PaperPodcastGenerator:
         except Exception as e:
             raise Exception(f"讀取PDF文件失敗: {str(e)}")
     
+    def _write_cache(self, cache_path: Path, content: str):
+        """寫入本地快取，失敗時只記錄警告，不影響主流程"""
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            # 先寫入同目錄的暫存檔再以 os.replace 原子性地換上，中斷的寫入不會留下不完整的快取
+            fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    f.write(content)
+                os.replace(tmp_path, cache_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            logging.warning("寫入快取 %s 失敗: %s", cache_path, e)
+
     def extract_paper_info(self, pdf_data: bytes) -> PaperInfo:
         """使用Gemini結構化輸出從PDF中提取論文資訊"""
         try:
+            # 以模型、提示詞與 PDF 內容的雜湊作為快取鍵，模型或提示詞變更時自動失效
+            cache_key = hashlib.sha256(f"{GEMINI_MODELS['info_extraction']}\n{INFO_EXTRACTION_PROMPT}\n".encode('utf-8'))
+            cache_key.update(pdf_data)
+            cache_path = PAPER_INFO_CACHE_DIR / f"{cache_key.hexdigest()}.json"
+            if cache_path.exists():
+                try:
+                    paper_info = PaperInfo.model_validate_json(cache_path.read_bytes())
+                    logging.info("♻️ 使用快取的論文資訊: %s", paper_info.title)
+                    return paper_info
+                except (OSError, ValueError) as e:
+                    # 快取損毀或 PaperInfo 結構已變更，改為重新呼叫 Gemini 並覆寫快取
+                    logging.warning("⚠️ 快取的論文資訊 %s 無法使用，重新分析: %s", cache_path, e)
+
             logging.info("正在分析論文內容...")
-            prompt = """
-            請分析這篇學術論文，並用繁體中文提取以下關鍵資訊：
-            1. 將論文標題翻譯成繁體中文
-            2. 提取論文作者列表（保持原文名稱）
-            3. 將論文摘要翻譯成繁體中文，大約200-300字
-            4. 識別主要研究領域
-            5. 總結3-5個核心創新點或貢獻
-            6. 簡述研究方法
-            7. 概括主要結果或發現
-            8. 提供3-5個最相關的關鍵字標籤 (tags)
-            請確保所有內容都使用繁體中文，並且準確反映論文的核心內容。
-            """
-            
-            response = self.client.models.generate_content(
+            response = self._call_with_retry(
+                self.client.models.generate_content,
                 model=GEMINI_MODELS["info_extraction"],
                 contents=[
                     types.Part.from_bytes(
                         data=pdf_data,
                         mime_type='application/pdf'
                     ), 
-                    prompt
+                    INFO_EXTRACTION_PROMPT
                 ],
-                config={
-                    "response_mime_type": "application/json",
-                    "response_schema": PaperInfo,
-                }
+                config=INFO_EXTRACTION_CONFIG
             )
             
             paper_info = PaperInfo.model_validate_json(response.text)
-            logging.info(f"✅ 成功提取論文資訊: {paper_info.title}")
+            logging.info("✅ 成功提取論文資訊: %s", paper_info.title)
+            self._write_cache(cache_path, paper_info.model_dump_json())
             return paper_info
             
         except Exception as e:
@@ -207,7 +325,6 @@ class PaperPodcastGenerator:
             - 皆使用台灣用語、台灣連接詞，可以適時使用台灣狀聲詞。
             - 如果有需要描述語氣、情緒，使用 "{{}}"，例如 "{{哈哈大笑}}" 或 "{{難過情緒}}"。
             - 只需要輸出逐字稿，不需要其他說明。
-            - <其他要求，例如流程、架構、著重特定聽者>
 
             逐字稿範例：
             ```
@@ -231,10 +348,23 @@ class PaperPodcastGenerator:
             ```
             
             """
-            response = self.client.models.generate_content(
+            # 提示詞已包含論文資訊、主持人與範本，以其雜湊作為快取鍵，範本變更時自動失效
+            cache_key = hashlib.sha256(f"{GEMINI_MODELS['script_generation']}\n{prompt}".encode('utf-8')).hexdigest()
+            cache_path = SCRIPT_CACHE_DIR / f"{cache_key}.txt"
+            if cache_path.exists():
+                try:
+                    script_text = cache_path.read_text(encoding='utf-8')
+                    logging.info("♻️ 使用快取的播客逐字稿")
+                    return script_text
+                except (OSError, ValueError) as e:
+                    logging.warning("⚠️ 快取的播客逐字稿 %s 無法使用，重新生成: %s", cache_path, e)
+
+            response = self._call_with_retry(
+                self.client.models.generate_content,
                 model=GEMINI_MODELS["script_generation"],
                 contents=prompt,
             )
+            self._write_cache(cache_path, response.text)
             return response.text
             
         except Exception as e:
@@ -244,39 +374,31 @@ class PaperPodcastGenerator:
         """將逐字稿轉換為語音並回傳二進位資料"""
         try:
             logging.info("正在生成語音...")
-            response = self.client.models.generate_content(
+            response = self._call_with_retry(
+                self.client.models.generate_content,
                 model=GEMINI_MODELS["tts"],
                 contents=script_text,
-                config=GenerateContentConfig(
-                    response_modalities=["AUDIO"],
-                    speech_config=SpeechConfig(
-                        multi_speaker_voice_config=MultiSpeakerVoiceConfig(
-                            speaker_voice_configs=[
-                                SpeakerVoiceConfig(speaker=self.speaker1, voice_config=VoiceConfig(prebuilt_voice_config=PrebuiltVoiceConfig(voice_name=self.speaker1_voice))),
-                                SpeakerVoiceConfig(speaker=self.speaker2, voice_config=VoiceConfig(prebuilt_voice_config=PrebuiltVoiceConfig(voice_name=self.speaker2_voice))),
-                            ]
-                        )
-                    )
-                )
+                config=self._tts_config
             )
             
             audio_data = response.candidates[0].content.parts[0].inline_data.data
-            logging.info(f"🎵 語音生成完畢，大小: {len(audio_data):,} bytes")
+            logging.info("🎵 語音生成完畢，大小: %d bytes", len(audio_data))
             return audio_data
             
         except Exception as e:
             raise Exception(f"生成語音失敗: {str(e)}")
     
-    def process_paper(self, pdf_url: str = None, pdf_data: bytes = None) -> Dict[str, Any]:
+    def process_paper(self, pdf_url: str = None, pdf_data: bytes = None, headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
         """
         完整處理單篇論文，從下載或直接使用 PDF 資料到生成所有內容，並在記憶體中回傳。
         
         Args:
             pdf_url (str, optional): 論文的 PDF URL。
             pdf_data (bytes, optional): 直接提供的 PDF 二進位資料。
+            headers (Dict[str, str], optional): 下載 pdf_url 時附加的請求標頭。
             
         Returns:
-            Dict[str, Any]: 包含所有生成資訊和音檔資料的字典。
+            Dict[str, Any]: 包含所有生成資訊、編碼後的音檔資料 (audio_data) 與其副檔名 (audio_ext) 的字典。
         """
         try:
             # 1. 獲取 PDF 資料
@@ -285,7 +407,7 @@ class PaperPodcastGenerator:
                 if not pdf_data.startswith(b'%PDF'):
                     raise ValueError("提供的資料不是有效的PDF格式")
             elif pdf_url is not None:
-                pdf_data = self.read_pdf_from_url(pdf_url)
+                pdf_data = self.read_pdf_from_url(pdf_url, headers)
             else:
                 raise ValueError("必須提供 pdf_url 或 pdf_data 其中之一")
             
@@ -295,12 +417,14 @@ class PaperPodcastGenerator:
             # 3. 生成逐字稿 (返回純文字)
             script_text = self.generate_podcast_script(paper_info)
             
-            # 4. 生成音檔 (返回二進位資料)
-            audio_data = self.generate_audio(script_text)
+            # 4. 生成音檔 (返回 raw PCM)
+            pcm_data = self.generate_audio(script_text)
 
-            # 5. 計算音檔時長
-            duration_seconds = self._get_audio_duration(audio_data)
-            logging.info(f"⏱️ 音檔時長計算完成: {duration_seconds:.2f} 秒")
+            # 5. 計算音檔時長，並直接編碼為設定的格式，呼叫端不需再自行轉換
+            duration_seconds = self._get_audio_duration(pcm_data)
+            logging.info("⏱️ 音檔時長計算完成: %.2f 秒", duration_seconds)
+            audio_data, audio_ext = encode_pcm_audio(pcm_data, self.audio_format)
+            del pcm_data
             
             logging.info("\n✅ 播客生成完成！所有內容已在記憶體中準備好。")
             
@@ -312,6 +436,7 @@ class PaperPodcastGenerator:
                 "podcast_title": podcast_title,
                 "script": script_text,
                 "audio_data": audio_data,
+                "audio_ext": audio_ext,
                 "duration_seconds": duration_seconds,
             }
             
@@ -369,24 +494,21 @@ def main():
         results = generator.process_paper(pdf_url)
         
         logging.info("\n=== 處理結果摘要 ===")
-        logging.info(f"🎧 Podcast 標題: {results['podcast_title']}")
-        logging.info(f"🎵 音檔大小: {len(results['audio_data']) / 1024:.2f} KB")
-        logging.info(f"⏱️ 音檔時長: {results['duration_seconds']:.2f} 秒")
-        logging.info(f"📄 論文標題: {results['paper_info'].title}")
-        logging.info(f"📝 逐字稿長度: {len(results['script'])} 字")
+        logging.info("🎧 Podcast 標題: %s", results['podcast_title'])
+        logging.info("🎵 音檔大小: %.2f KB", len(results['audio_data']) / 1024)
+        logging.info("⏱️ 音檔時長: %.2f 秒", results['duration_seconds'])
+        logging.info("📄 論文標題: %s", results['paper_info'].title)
+        logging.info("📝 逐字稿長度: %s 字", len(results['script']))
         
         # 為了測試，可以選擇性地儲存音檔
-        save_choice = input("是否要將音檔儲存為 'test_output.wav'？(y/N): ").lower()
+        output_name = f"test_output{results['audio_ext']}"
+        save_choice = input(f"是否要將音檔儲存為 '{output_name}'？(y/N): ").lower()
         if save_choice == 'y':
-            with wave.open('test_output.wav', 'wb') as wf:
-                wf.setnchannels(1)
-                wf.setsampwidth(2)
-                wf.setframerate(24000)
-                wf.writeframes(results['audio_data'])
+            Path(output_name).write_bytes(results['audio_data'])
             logging.info("音檔已儲存。")
         
     except Exception as e:
-        logging.error(f"\n❌ 發生錯誤: {e}", exc_info=True)
+        logging.error("\n❌ 發生錯誤: %s", e, exc_info=True)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,68 @@
 # -*- coding: utf-8 -*-
+import io
 import logging
-from typing import Optional, List, Dict, Any
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from itertools import batched
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Optional, List, Dict, Any, Callable, Tuple, Union
 from supabase import Client, create_client
 from config import Settings
 
+# 依副檔名決定上傳音檔的 Content-Type，避免載入 mimetypes 資料庫
+AUDIO_CONTENT_TYPES = {
+    ".wav": "audio/wav",
+    ".mp3": "audio/mpeg",
+    ".ogg": "audio/ogg",
+}
+
+def _open_upload_body(audio_data: Union[bytes, bytearray, memoryview, BinaryIO]) -> Tuple[Union[bytes, BinaryIO], bool]:
+    """
+    將音檔資料轉為 storage3 會直接上傳的型別，回傳 (上傳內容, 是否需由呼叫端關閉)。
+    storage3 只會直接傳遞 bytes、BufferedReader 與 FileIO，其他型別都會被當成路徑交給 open() 而失敗。
+    """
+    if isinstance(audio_data, bytes):
+        return audio_data, False
+    if isinstance(audio_data, (bytearray, memoryview)):
+        return bytes(audio_data), False
+    if isinstance(audio_data, (io.BufferedReader, io.FileIO)):
+        audio_data.seek(0)
+        return audio_data, False
+    audio_data.flush()
+    try:
+        fd = audio_data.fileno()
+    except (AttributeError, OSError):
+        # 沒有檔案描述符的記憶體檔案 (如 BytesIO)，內容本來就在記憶體中，直接取出
+        audio_data.seek(0)
+        return audio_data.read(), False
+    # 有檔案描述符的暫存檔 (如 TemporaryFile)，以唯讀 BufferedReader 重新開啟同一個檔案，讓 httpx 分段讀取串流上傳
+    reader = open(fd, "rb", closefd=False)
+    reader.seek(0)
+    return reader, True
+
+# 以 (URL, KEY) 為鍵共用 Supabase 客戶端，讓同一行程中的所有服務共用 keep-alive 連線
+_CLIENT_CACHE: Dict[Tuple[str, str], Client] = {}
+_CLIENT_CACHE_LOCK = threading.Lock()
+
+def _get_shared_client(supabase_url: str, supabase_key: str) -> Client:
+    """取得 (必要時建立) 行程內共用的 Supabase 客戶端。"""
+    key = (supabase_url, supabase_key)
+    with _CLIENT_CACHE_LOCK:
+        client = _CLIENT_CACHE.get(key)
+        if client is None:
+            client = _CLIENT_CACHE[key] = create_client(supabase_url, supabase_key)
+        return client
+
+# 論文存在性查詢結果的行程內快取設定：最多保留的筆數與有效秒數
+EXISTENCE_CACHE_MAX_SIZE = 4096
+EXISTENCE_CACHE_TTL_SECONDS = 300
+
+# 批次存在性查詢每次 IN 查詢的 ID 數量上限，避免超過 PostgREST 的 URL 長度限制
+EXISTENCE_QUERY_CHUNK_SIZE = 200
+
 class SupabaseService:
     """
     封裝所有與 Supabase 互動的操作。
@@ -12,76 +71,283 @@ class SupabaseService:
         """
         初始化 Supabase 客戶端。
         """
-        self.client: Client = create_client(settings.SUPABASE_URL, settings.SUPABASE_KEY)
+        self.client: Client = _get_shared_client(settings.SUPABASE_URL, settings.SUPABASE_KEY)
         self.bucket_name: str = settings.SUPABASE_BUCKET_NAME
-        logging.info("Supabase 服務已成功初始化。")
+        self.public_url_base: str = f"{settings.SUPABASE_URL.rstrip('/')}/storage/v1/object/public"
+        # 以 service key 下載 Storage 檔案，私有或受 RLS 保護的 bucket 也能讀取
+        self.authenticated_url_base: str = f"{settings.SUPABASE_URL.rstrip('/')}/storage/v1/object/authenticated"
+        self.storage_auth_headers: Dict[str, str] = {
+            "Authorization": f"Bearer {settings.SUPABASE_KEY}",
+            "apikey": settings.SUPABASE_KEY,
+        }
+        self.build_public_url_locally: bool = settings.SUPABASE_LOCAL_PUBLIC_URL
+
+        # 本地已處理論文快取 (arxiv_id -> 標題)，讓常見的「沒有新論文」情況不必詢問 Supabase
+        self._seen_lock = threading.Lock()
+        seen_db_path = Path(settings.SEEN_IDS_DB_PATH)
+        seen_db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._seen_db = sqlite3.connect(seen_db_path, check_same_thread=False)
+        self._seen_db.execute("CREATE TABLE IF NOT EXISTS seen_papers (arxiv_id TEXT PRIMARY KEY, title TEXT)")
+        self._seen_papers: Dict[str, str] = dict(self._seen_db.execute("SELECT arxiv_id, title FROM seen_papers"))
+
+        # 行程內的存在性查詢快取 (arxiv_id -> (查詢時間, 標題或 None))，主要用於避免重複查詢「不存在」的論文；
+        # 已存在的論文由上面的本地快取永久記錄
+        self._exists_cache: "OrderedDict[str, Tuple[float, Optional[str]]]" = OrderedDict()
+        self._exists_cache_lock = threading.Lock()
+        self._exists_cache_hits = 0
+        self._exists_cache_misses = 0
+        logging.info("Supabase 服務已成功初始化 (本地快取 %d 筆已處理論文)。", len(self._seen_papers))
 
-    def check_paper_exists(self, arxiv_id: str) -> Optional[str]:
+    def _get_cached_existence(self, arxiv_id: str) -> Tuple[bool, Optional[str]]:
         """
-        檢查論文是否已存在於資料庫中。
+        查詢行程內快取，回傳 (是否命中, 標題或 None)。超過 TTL 的項目視為未命中並移除。
         """
-        try:
-            response = self.client.table("papers").select("title").eq("arxiv_id", arxiv_id).execute()
-            if response.data:
-                return response.data[0]['title']
-            return None
-        except Exception as e:
-            logging.error(f"檢查論文 '{arxiv_id}' 時發生錯誤: {e}")
-            # 在發生錯誤時，我們假設論文不存在，以允許重試
-            return None
+        with self._exists_cache_lock:
+            cached = self._exists_cache.get(arxiv_id)
+            if cached is not None and time.monotonic() - cached[0] < EXISTENCE_CACHE_TTL_SECONDS:
+                self._exists_cache.move_to_end(arxiv_id)
+                self._exists_cache_hits += 1
+                return True, cached[1]
+            if cached is not None:
+                del self._exists_cache[arxiv_id]
+            self._exists_cache_misses += 1
+            return False, None
+
+    def _set_cached_existence(self, arxiv_id: str, title: Optional[str]):
+        """
+        寫入行程內快取，超過容量時淘汰最久未使用的項目。
+        """
+        with self._exists_cache_lock:
+            self._exists_cache[arxiv_id] = (time.monotonic(), title)
+            self._exists_cache.move_to_end(arxiv_id)
+            while len(self._exists_cache) > EXISTENCE_CACHE_MAX_SIZE:
+                self._exists_cache.popitem(last=False)
+
+    def existence_cache_info(self) -> Dict[str, int]:
+        """
+        回傳行程內存在性快取的統計資訊。
+        """
+        with self._exists_cache_lock:
+            return {
+                "hits": self._exists_cache_hits,
+                "misses": self._exists_cache_misses,
+                "size": len(self._exists_cache),
+            }
+
+    def maybe_seen(self, arxiv_id: str) -> bool:
+        """
+        檢查論文是否已記錄於本地快取中，不需任何網路請求。
+        """
+        return arxiv_id in self._seen_papers
+
+    def remember(self, papers: Dict[str, str]):
+        """
+        將已存在於資料庫中的論文 (arxiv_id -> 標題) 記錄到本地快取並寫入磁碟。
+        """
+        new_papers = {arxiv_id: title for arxiv_id, title in papers.items() if arxiv_id not in self._seen_papers}
+        if not new_papers:
+            return
+        for arxiv_id, title in new_papers.items():
+            self._set_cached_existence(arxiv_id, title)
+        with self._seen_lock:
+            self._seen_papers.update(new_papers)
+            with self._seen_db:
+                self._seen_db.executemany(
+                    "INSERT OR IGNORE INTO seen_papers (arxiv_id, title) VALUES (?, ?)",
+                    new_papers.items()
+                )
+
+    def check_papers_exist(self, arxiv_ids: List[str]) -> Dict[str, str]:
+        """
+        以 IN 查詢批次檢查多篇論文是否已存在於資料庫中 (每 EXISTENCE_QUERY_CHUNK_SIZE 筆一次請求)，
+        回傳已存在論文的 arxiv_id -> 標題。
+        已記錄於本地快取的 ID 直接視為存在，只有未知的 ID 才會查詢 Supabase。
+        """
+        existing = {arxiv_id: self._seen_papers[arxiv_id] for arxiv_id in arxiv_ids if self.maybe_seen(arxiv_id)}
+        unknown_ids = []
+        for arxiv_id in arxiv_ids:
+            if arxiv_id in existing:
+                continue
+            hit, title = self._get_cached_existence(arxiv_id)
+            if not hit:
+                unknown_ids.append(arxiv_id)
+            elif title is not None:
+                existing[arxiv_id] = title
+        for chunk in batched(unknown_ids, EXISTENCE_QUERY_CHUNK_SIZE):
+            try:
+                response = self.client.table("papers").select("arxiv_id,title").in_("arxiv_id", list(chunk)).execute()
+            except Exception as e:
+                logging.error("批次檢查論文是否存在時發生錯誤: %s", e)
+                # 在發生錯誤時，我們假設這批未知的論文皆不存在，以允許重試
+                continue
+            found = {row['arxiv_id']: row['title'] for row in response.data}
+            self.remember(found)
+            for arxiv_id in chunk:
+                if arxiv_id not in found:
+                    self._set_cached_existence(arxiv_id, None)
+            existing |= found
+        return existing
+
+    def get_public_url(self, destination_path: str) -> str:
+        """
+        組出 Storage 檔案的公開 URL。
+        公開 bucket 的 URL 是固定格式，直接在本地組出，不需任何網路請求，也不需等待上傳完成。
+        若 Storage 前面有自訂網域等特殊設定，可將 SUPABASE_LOCAL_PUBLIC_URL 設為 false 改用 SDK 產生。
+        """
+        if not self.build_public_url_locally:
+            return self.client.storage.from_(self.bucket_name).get_public_url(destination_path)
+        return f"{self.public_url_base}/{self.bucket_name}/{destination_path}"
+
+    def get_authenticated_download(self, file_url: str) -> Tuple[str, Dict[str, str]]:
+        """
+        將 Storage 檔案的公開 URL 轉為帶驗證的下載端點，回傳 (URL, 請求標頭)，
+        讓呼叫端以串流方式下載，不必透過 SDK 將整個檔案載入記憶體。
+        """
+        # 從完整 URL 中提取檔案路徑
+        # URL 格式: https://xxx.supabase.co/storage/v1/object/public/bucket/path
+        url_parts = file_url.split('/storage/v1/object/public/')
+        if len(url_parts) != 2:
+            raise ValueError(f"無效的 Storage URL 格式: {file_url}")
+
+        # 分出 bucket 名稱與實際檔案路徑
+        path_parts = url_parts[1].split('/', 1)
+        if len(path_parts) != 2:
+            raise ValueError(f"無法解析檔案路徑: {url_parts[1]}")
+
+        bucket_name, file_path = path_parts
+        # 一律以設定中的 SUPABASE_URL 組出端點，service key 不會被送往其他主機
+        return f"{self.authenticated_url_base}/{bucket_name}/{file_path}", self.storage_auth_headers
 
-    def upload_audio(self, destination_path: str, audio_data: bytes) -> str:
+    def upload_audio(self, destination_path: str, audio_data: Union[bytes, bytearray, memoryview, BinaryIO]) -> str:
         """
         上傳音訊檔案到 Supabase Storage 並返回公開 URL。
         使用 upsert=True，如果檔案已存在則會覆蓋，不存在則會建立。
+        audio_data 也可以是檔案物件：有檔案描述符的暫存檔 (如 TemporaryFile) 會從頭分段讀取並串流上傳，
+        不需先整份載入記憶體；BytesIO 等記憶體檔案則取出內容後上傳。
         """
+        body, close_body = None, False
         try:
+            body, close_body = _open_upload_body(audio_data)
             self.client.storage.from_(self.bucket_name).upload(
                 path=destination_path,
-                file=audio_data,
-                file_options={"contentType": "audio/wav", "upsert": "true"}
+                file=body,
+                # storage3 只認小寫的 "content-type"，會將其作為 multipart 檔案部分的 Content-Type
+                file_options={"content-type": AUDIO_CONTENT_TYPES[Path(destination_path).suffix], "upsert": "true"}
             )
-            logging.info(f"🔼 成功上傳/更新 Storage 中的音檔: {destination_path}")
+            logging.info("🔼 成功上傳/更新 Storage 中的音檔: %s", destination_path)
 
-            # 獲取公開 URL
-            public_url = self.client.storage.from_(self.bucket_name).get_public_url(destination_path)
-            logging.info(f"🔗 成功獲取音檔的公開 URL: {public_url}")
+            public_url = self.get_public_url(destination_path)
+            logging.info("🔗 成功獲取音檔的公開 URL: %s", public_url)
             return public_url
         except Exception as e:
-            logging.error(f"上傳音檔到 Storage 時失敗: {e}", exc_info=True)
+            logging.error("上傳音檔到 Storage 時失敗: %s", e, exc_info=True)
             raise
+        finally:
+            if close_body:
+                body.close()
 
     def insert_paper(self, paper_data: dict):
         """
         將處理完的論文資訊插入到 Supabase 資料庫中。
         """
         try:
-            response = self.client.table("papers").insert(paper_data).execute()
-            if not response.data:
-                raise Exception("插入資料失敗，沒有回傳資料。")
+            # 不要求回傳整列資料 (其中 full_text 為完整逐字稿)，失敗時 postgrest 會直接拋出 APIError
+            self.client.table("papers").insert(paper_data, returning="minimal").execute()
             
-            logging.info(f"✅ 成功將論文 '{paper_data['title']}' 插入到資料庫")
-            return response.data[0]
+            logging.info("✅ 成功將論文 '%s' 插入到資料庫", paper_data['title'])
+            self.remember({paper_data['arxiv_id']: paper_data['title']})
         except Exception as e:
-            logging.error(f"將論文 '{paper_data.get('title', 'N/A')}' 插入資料庫時失敗: {e}")
+            logging.error("將論文 '%s' 插入資料庫時失敗: %s", paper_data.get('title', 'N/A'), e)
             raise
 
-    def get_pending_uploads(self, limit: int = 10) -> List[Dict[str, Any]]:
+    def upload_audio_and_insert(
+        self,
+        destination_path: str,
+        audio_data: bytes,
+        paper_data: dict,
+        insert_func: Optional[Callable[[dict], Any]] = None,
+        rollback_func: Optional[Callable[[dict, Exception], Any]] = None
+    ) -> Any:
+        """
+        在背景上傳音檔的同時寫入論文資料，重疊兩段網路延遲。
+        paper_data 中的 audio_url 應事先以 get_public_url 組出；若音檔上傳失敗，會回滾已寫入的論文資料。
+        
+        Args:
+            destination_path: 音檔在 Storage 中的路徑
+            audio_data: 音檔資料
+            paper_data: 要寫入 papers 資料表的資料
+            insert_func: 寫入資料的函式，預設為 insert_paper
+            rollback_func: 音檔上傳失敗時以 (paper_data, 上傳錯誤) 呼叫的回滾函式，預設刪除論文
+        
+        Returns:
+            insert_func 的回傳值
+        """
+        insert_func = insert_func or self.insert_paper
+        rollback_func = rollback_func or (lambda paper_data, error: self.delete_paper(paper_data['arxiv_id']))
+        with ThreadPoolExecutor(max_workers=1) as upload_executor:
+            upload_future = upload_executor.submit(self.upload_audio, destination_path, audio_data)
+            try:
+                paper_record = insert_func(paper_data)
+            except Exception:
+                # 寫入失敗時仍等待背景上傳結束並記錄其錯誤，避免上傳的例外被默默丟棄
+                upload_error = upload_future.exception()
+                if upload_error is not None:
+                    logging.error("背景上傳音檔 %s 也失敗了: %s", destination_path, upload_error)
+                raise
+            try:
+                upload_future.result()
+            except Exception as upload_error:
+                # 音檔上傳失敗時回滾資料庫記錄，讓下次執行能重新處理這篇論文；
+                # 回滾本身失敗時只記錄下來，重新拋出的仍是原本的上傳錯誤
+                try:
+                    rollback_func(paper_data, upload_error)
+                except Exception as rollback_error:
+                    logging.error("回滾論文 '%s' 失敗，資料庫中可能殘留沒有音檔的記錄: %s", paper_data['arxiv_id'], rollback_error)
+                raise
+        return paper_record
+
+    def delete_paper(self, arxiv_id: str):
         """
-        獲取狀態為 pending 的上傳檔案列表。
+        從資料庫中刪除論文，並從本地快取中移除，用於音檔上傳失敗時回滾已插入的資料。
         """
         try:
-            response = self.client.table("pending_uploads")\
-                .select("*")\
-                .eq("status", "pending")\
-                .order("created_at", desc=False)\
-                .limit(limit)\
-                .execute()
-            
-            logging.info(f"📋 找到 {len(response.data)} 個待處理的上傳檔案")
+            self.client.table("papers").delete().eq("arxiv_id", arxiv_id).execute()
+            with self._seen_lock:
+                self._seen_papers.pop(arxiv_id, None)
+                with self._seen_db:
+                    self._seen_db.execute("DELETE FROM seen_papers WHERE arxiv_id = ?", (arxiv_id,))
+            self._set_cached_existence(arxiv_id, None)
+            logging.info("🗑️ 已從資料庫刪除論文: %s", arxiv_id)
+        except Exception as e:
+            logging.error("從資料庫刪除論文 '%s' 時失敗: %s", arxiv_id, e)
+            raise
+
+    def rollback_finalized_upload(self, upload_id: str, arxiv_id: str, error_message: str = None):
+        """
+        回滾 insert_paper_from_upload：透過 rollback_finalized_upload 資料庫函式，
+        在同一個交易中刪除論文並將上傳檔案標記為 failed，不會留下 completed 卻沒有論文的記錄。
+        """
+        try:
+            self.client.rpc(
+                "rollback_finalized_upload",
+                {"p_upload_id": upload_id, "p_arxiv_id": arxiv_id, "p_error_message": error_message or None}
+            ).execute()
+            logging.info("🗑️ 已回滾用戶上傳論文 %s，並將上傳檔案 %s 標記為 failed", arxiv_id, upload_id)
+        except Exception as e:
+            logging.error("回滾用戶上傳檔案 %s 時失敗: %s", upload_id, e)
+            raise
+
+    def claim_pending_uploads(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """
+        原子地認領待處理的上傳檔案，並將其狀態設為 processing。
+        透過 claim_pending_uploads 資料庫函式 (FOR UPDATE SKIP LOCKED)，多個 worker 同時執行也不會重複處理同一筆資料。
+        """
+        try:
+            response = self.client.rpc("claim_pending_uploads", {"n": limit}).execute()
+            logging.info("📋 認領了 %d 個待處理的上傳檔案", len(response.data))
             return response.data
         except Exception as e:
-            logging.error(f"獲取待處理上傳檔案時發生錯誤: {e}")
+            logging.error("認領待處理上傳檔案時發生錯誤: %s", e)
             return []
 
     def update_pending_upload_status(self, upload_id: str, status: str, error_message: str = None, 
@@ -90,97 +356,45 @@ class SupabaseService:
         更新 pending_upload 的狀態和相關資訊。
         """
         try:
-            update_data = {
-                "status": status,
-                "updated_at": "now()"
+            params = {
+                "p_upload_id": upload_id,
+                "p_status": status,
+                "p_error_message": error_message or None,
             }
             
-            if error_message:
-                update_data["error_message"] = error_message
-            
             if extracted_info:
-                if "title" in extracted_info:
-                    update_data["extracted_title"] = extracted_info["title"]
-                if "authors" in extracted_info:
-                    update_data["extracted_authors"] = extracted_info["authors"]
-                if "abstract" in extracted_info:
-                    update_data["extracted_abstract"] = extracted_info["abstract"]
+                params["p_extracted"] = {
+                    key: extracted_info[key]
+                    for key in ("title", "authors", "abstract")
+                    if key in extracted_info
+                }
             
-            response = self.client.table("pending_uploads")\
-                .update(update_data)\
-                .eq("id", upload_id)\
-                .execute()
+            response = self.client.rpc("update_pending_upload_status", params).execute()
             
-            logging.info(f"✅ 已更新上傳檔案 {upload_id} 的狀態為: {status}")
+            logging.info("✅ 已更新上傳檔案 %s 的狀態為: %s", upload_id, status)
             return response.data[0] if response.data else None
         except Exception as e:
-            logging.error(f"更新上傳檔案狀態時發生錯誤: {e}")
-            raise
-
-    def download_file_from_storage(self, file_url: str) -> bytes:
-        """
-        從 Supabase Storage 下載檔案。
-        """
-        try:
-            # 從完整 URL 中提取檔案路徑
-            # URL 格式: https://xxx.supabase.co/storage/v1/object/public/bucket/path
-            url_parts = file_url.split('/storage/v1/object/public/')
-            if len(url_parts) != 2:
-                raise ValueError(f"無效的 Storage URL 格式: {file_url}")
-            
-            path_with_bucket = url_parts[1]
-            # 移除 bucket 名稱，獲取實際檔案路徑
-            path_parts = path_with_bucket.split('/', 1)
-            if len(path_parts) != 2:
-                raise ValueError(f"無法解析檔案路徑: {path_with_bucket}")
-            
-            bucket_name = path_parts[0]
-            file_path = path_parts[1]
-            
-            logging.info(f"正在從 Storage 下載檔案: {file_path}")
-            response = self.client.storage.from_(bucket_name).download(file_path)
-            
-            logging.info(f"✅ 成功下載檔案，大小: {len(response):,} bytes")
-            return response
-        except Exception as e:
-            logging.error(f"從 Storage 下載檔案失敗: {e}")
+            logging.error("更新上傳檔案狀態時發生錯誤: %s", e)
             raise
 
     def insert_paper_from_upload(self, paper_data: dict, upload_id: str):
         """
         將處理完的用戶上傳論文資訊插入到 papers 資料庫中，並更新 pending_uploads 狀態。
+        兩個寫入透過 finalize_upload 資料庫函式在同一個交易中完成；失敗時由呼叫端將狀態更新為 failed，
+        已完成後才發現音檔上傳失敗時則以 rollback_finalized_upload 回滾。
         """
         try:
-            # 插入論文資料
-            response = self.client.table("papers").insert(paper_data).execute()
+            response = self.client.rpc(
+                "finalize_upload",
+                {"p_upload_id": upload_id, "p_paper": paper_data}
+            ).execute()
             if not response.data:
                 raise Exception("插入論文資料失敗，沒有回傳資料。")
             
-            paper_record = response.data[0]
-            logging.info(f"✅ 成功將用戶上傳論文 '{paper_data['title']}' 插入到資料庫")
-            
-            # 更新 pending_uploads 狀態為 completed
-            self.update_pending_upload_status(
-                upload_id=upload_id,
-                status="completed",
-                extracted_info={
-                    "title": paper_data['title'],
-                    "authors": paper_data.get('authors', []),
-                    "abstract": paper_data.get('summary', '')
-                }
-            )
-            
+            # finalize_upload 只回傳 {"id": ..., "title": ...}
+            paper_record = response.data
+            logging.info("✅ 成功將用戶上傳論文 '%s' 插入到資料庫，並將上傳檔案 %s 標記為 completed", paper_data['title'], upload_id)
             return paper_record
         except Exception as e:
-            # 如果插入失敗，更新狀態為 failed
-            try:
-                self.update_pending_upload_status(
-                    upload_id=upload_id,
-                    status="failed",
-                    error_message=str(e)
-                )
-            except:
-                pass  # 避免雙重異常
-            
-            logging.error(f"將用戶上傳論文 '{paper_data.get('title', 'N/A')}' 插入資料庫時失敗: {e}")
+            logging.error("將用戶上傳論文 '%s' 插入資料庫時失敗: %s", paper_data.get('title', 'N/A'), e)
             raise 
\ No newline at end of file
@@ -0,0 +1,5 @@
+-- 讓 upload_processor 輪詢待處理上傳檔案時只需掃描 pending 狀態的資料列，
+-- 沒有待處理檔案時查詢成本與資料表大小無關
+create index if not exists pending_uploads_pending_created_at_idx
+    on public.pending_uploads (created_at)
+    where status = 'pending';
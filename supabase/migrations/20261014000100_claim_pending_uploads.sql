@@ -0,0 +1,20 @@
+-- 以單一陳述式原子地認領待處理的上傳檔案：
+-- 將最舊的 n 筆 pending 資料列標記為 processing 並回傳，
+-- FOR UPDATE SKIP LOCKED 確保同時執行的多個 worker 不會認領到同一筆資料
+create or replace function public.claim_pending_uploads(n int)
+returns setof public.pending_uploads
+language sql
+as $$
+    update public.pending_uploads
+    set status = 'processing',
+        updated_at = now()
+    where id in (
+        select id
+        from public.pending_uploads
+        where status = 'pending'
+        order by created_at
+        limit n
+        for update skip locked
+    )
+    returning *;
+$$;
@@ -0,0 +1,35 @@
+-- 將更新上傳檔案狀態的查詢改為以 rpc() 呼叫的資料庫函式：
+-- 函式內的 SQL 會在連線中重用查詢計畫，PostgREST 也不必在每次請求時把 URL 查詢參數轉譯為 SQL
+
+-- 更新上傳檔案的狀態；error_message 與擷取出的論文資訊只有提供時才會覆寫
+create or replace function public.update_pending_upload_status(
+    p_upload_id public.pending_uploads.id%type,
+    p_status text,
+    p_error_message text default null,
+    p_extracted jsonb default null
+)
+returns setof public.pending_uploads
+language plpgsql
+as $$
+declare
+    -- 以 pending_uploads 的資料列型別轉換各欄位，不必假設其欄位型別
+    v_new public.pending_uploads := jsonb_populate_record(null::public.pending_uploads, jsonb_build_object(
+        'status', p_status,
+        'error_message', p_error_message,
+        'extracted_title', p_extracted -> 'title',
+        'extracted_authors', p_extracted -> 'authors',
+        'extracted_abstract', p_extracted -> 'abstract'
+    ));
+begin
+    return query
+    update public.pending_uploads
+    set status = v_new.status,
+        error_message = coalesce(v_new.error_message, error_message),
+        extracted_title = coalesce(v_new.extracted_title, extracted_title),
+        extracted_authors = coalesce(v_new.extracted_authors, extracted_authors),
+        extracted_abstract = coalesce(v_new.extracted_abstract, extracted_abstract),
+        updated_at = now()
+    where id = p_upload_id
+    returning *;
+end;
+$$;
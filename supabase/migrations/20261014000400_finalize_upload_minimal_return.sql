@@ -0,0 +1,44 @@
+-- finalize_upload 改為只回傳新論文的 id 與標題：
+-- 完整資料列包含整份逐字稿 (full_text)，呼叫端並不需要，不必再由 PostgREST 編碼回傳
+-- 回傳型別改變時無法 create or replace，須先移除舊函式
+drop function if exists public.finalize_upload(public.pending_uploads.id%type, jsonb);
+
+create or replace function public.finalize_upload(
+    p_upload_id public.pending_uploads.id%type,
+    p_paper jsonb
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_paper public.papers;
+    v_extracted public.pending_uploads;
+begin
+    insert into public.papers (
+        title, authors, journal, publish_date, summary, full_text, category, tags,
+        innovations, method, results, audio_url, duration_seconds, arxiv_url, pdf_url, arxiv_id
+    )
+    select
+        r.title, r.authors, r.journal, r.publish_date, r.summary, r.full_text, r.category, r.tags,
+        r.innovations, r.method, r.results, r.audio_url, r.duration_seconds, r.arxiv_url, r.pdf_url, r.arxiv_id
+    from jsonb_populate_record(null::public.papers, p_paper) as r
+    returning * into v_paper;
+
+    -- 以 pending_uploads 的資料列型別轉換擷取欄位，不必假設其欄位型別
+    v_extracted := jsonb_populate_record(null::public.pending_uploads, jsonb_build_object(
+        'extracted_title', p_paper -> 'title',
+        'extracted_authors', coalesce(p_paper -> 'authors', '[]'::jsonb),
+        'extracted_abstract', coalesce(p_paper -> 'summary', '""'::jsonb)
+    ));
+
+    update public.pending_uploads
+    set status = 'completed',
+        extracted_title = v_extracted.extracted_title,
+        extracted_authors = v_extracted.extracted_authors,
+        extracted_abstract = v_extracted.extracted_abstract,
+        updated_at = now()
+    where id = p_upload_id;
+
+    return jsonb_build_object('id', v_paper.id, 'title', v_paper.title);
+end;
+$$;
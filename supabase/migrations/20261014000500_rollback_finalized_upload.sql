@@ -0,0 +1,22 @@
+-- 音檔上傳失敗時回滾 finalize_upload：
+-- 刪除已插入的論文並將上傳檔案標記為 failed，兩個寫入在同一個交易中完成，
+-- 不會留下狀態為 completed 卻沒有對應論文的 pending_uploads 記錄
+create or replace function public.rollback_finalized_upload(
+    p_upload_id public.pending_uploads.id%type,
+    p_arxiv_id public.papers.arxiv_id%type,
+    p_error_message text default null
+)
+returns void
+language plpgsql
+as $$
+begin
+    delete from public.papers
+    where arxiv_id = p_arxiv_id;
+
+    update public.pending_uploads
+    set status = 'failed',
+        error_message = coalesce(p_error_message, error_message),
+        updated_at = now()
+    where id = p_upload_id;
+end;
+$$;
@@ -5,14 +5,14 @@
 """
 import logging
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Dict, Any
 from datetime import datetime
 
-from config import settings
+from config import get_settings
 from logging_config import setup_logging
 from podcast_generater import PaperPodcastGenerator, PaperInfo
 from services.supabase_service import SupabaseService
-from utils.audio_utils import convert_pcm_to_wav_in_memory
 
 
 class UploadProcessor:
@@ -20,16 +20,21 @@ class UploadProcessor:
     
     def __init__(self):
         """初始化處理器"""
-        self.supabase_service = SupabaseService(settings)
-        self.podcast_generator = PaperPodcastGenerator(settings.GEMINI_API_KEY)
+        self.settings = get_settings()
+        self.supabase_service = SupabaseService(self.settings)
+        self.podcast_generator = PaperPodcastGenerator(self.settings.GEMINI_API_KEY, audio_format=self.settings.AUDIO_FORMAT)
         logging.info("🚀 用戶上傳論文處理器已初始化")
     
+    def close(self):
+        """釋放 podcast 生成器持有的 HTTP 連線"""
+        self.podcast_generator.close()
+    
     def process_single_upload(self, upload_record: Dict[str, Any]) -> bool:
         """
         處理單個用戶上傳的檔案
         
         Args:
-            upload_record: pending_uploads 表格中的記錄
+            upload_record: pending_uploads 表格中已認領 (狀態為 processing) 的記錄
             
         Returns:
             bool: 處理是否成功
@@ -39,38 +44,27 @@ class UploadProcessor:
         file_url = upload_record['file_url']
         user_id = upload_record['user_id']
         
-        logging.info(f"📄 開始處理用戶上傳檔案: {original_filename} (ID: {upload_id})")
+        logging.info("📄 開始處理用戶上傳檔案: %s (ID: %s)", original_filename, upload_id)
         
         try:
-            # 1. 更新狀態為 processing
-            self.supabase_service.update_pending_upload_status(
-                upload_id=upload_id,
-                status="processing"
-            )
-            
-            # 2. 從 Storage 下載檔案
-            logging.info("📥 正在從 Storage 下載檔案...")
-            pdf_data = self.supabase_service.download_file_from_storage(file_url)
-            
-            # 3. 使用 podcast 生成器處理論文
-            logging.info("🎧 正在生成播客內容...")
-            podcast_result = self.podcast_generator.process_paper(pdf_data=pdf_data)
+            # 1. 使用 podcast 生成器處理論文
+            # 以 service key 從 Storage 的驗證端點串流下載，私有 bucket 也能讀取，
+            # 並沿用生成器預先配置緩衝區、大小上限、PDF 檔頭檢查與重試機制，不必先透過 SDK 整包載入記憶體
+            download_url, download_headers = self.supabase_service.get_authenticated_download(file_url)
+            logging.info("🎧 正在從 Storage 下載檔案並生成播客內容...")
+            podcast_result = self.podcast_generator.process_paper(pdf_url=download_url, headers=download_headers)
             
             paper_info: PaperInfo = podcast_result['paper_info']
             script: str = podcast_result['script']
             audio_data: bytes = podcast_result['audio_data']
+            audio_ext: str = podcast_result['audio_ext']
             duration: float = podcast_result.get('duration_seconds', 0)
             
-            # 4. 將 raw PCM 音訊轉換為 WAV 格式
-            wav_data = convert_pcm_to_wav_in_memory(audio_data)
-            
-            # 5. 上傳音檔到 Supabase Storage
-            logging.info("☁️ 正在上傳音檔到 Supabase Storage...")
+            # 2. 公開 URL 可直接由路徑決定，因此先組出 URL 並準備資料庫記錄
             # 使用上傳記錄的 ID 作為音檔檔名，確保唯一性
-            audio_dest_path = f"uploads/{upload_id}.wav"
-            audio_url = self.supabase_service.upload_audio(audio_dest_path, wav_data)
+            audio_dest_path = f"uploads/{upload_id}{audio_ext}"
+            audio_url = self.supabase_service.get_public_url(audio_dest_path)
             
-            # 6. 準備資料並寫入 papers 資料庫
             db_record = {
                 "title": paper_info.title,
                 "authors": paper_info.authors,
@@ -90,16 +84,26 @@ class UploadProcessor:
                 "arxiv_id": f"upload_{upload_id[:8]}"  # 生成一個唯一的標識符
             }
             
-            # 7. 插入到 papers 表格並更新 pending_uploads 狀態
-            paper_record = self.supabase_service.insert_paper_from_upload(db_record, upload_id)
+            # 3. 在背景上傳音檔到 Supabase Storage，同時在單一交易中插入 papers 並將 pending_uploads 標記為 completed；
+            #    音檔上傳失敗時同樣在單一交易中刪除論文並標記為 failed
+            logging.info("☁️ 正在上傳音檔到 Supabase Storage 並寫入資料庫...")
+            paper_record = self.supabase_service.upload_audio_and_insert(
+                audio_dest_path,
+                audio_data,
+                db_record,
+                insert_func=lambda paper_data: self.supabase_service.insert_paper_from_upload(paper_data, upload_id),
+                rollback_func=lambda paper_data, error: self.supabase_service.rollback_finalized_upload(
+                    upload_id, paper_data['arxiv_id'], str(error)
+                )
+            )
             
-            logging.info(f"🎉 成功處理用戶上傳論文: {paper_info.title}")
+            logging.info("🎉 成功處理用戶上傳論文: %s", paper_info.title)
             return True
             
         except Exception as e:
-            logging.error(f"處理用戶上傳檔案 {upload_id} 時發生錯誤: {e}", exc_info=True)
+            logging.error("處理用戶上傳檔案 %s 時發生錯誤: %s", upload_id, e, exc_info=True)
             
-            # 更新狀態為 failed
+            # 失敗路徑只寫入一次：狀態 failed 與錯誤訊息
             try:
                 self.supabase_service.update_pending_upload_status(
                     upload_id=upload_id,
@@ -107,7 +111,7 @@ class UploadProcessor:
                     error_message=str(e)
                 )
             except Exception as update_error:
-                logging.error(f"更新失敗狀態時發生錯誤: {update_error}")
+                logging.error("更新失敗狀態時發生錯誤: %s", update_error)
             
             return False
     
@@ -121,10 +125,10 @@ class UploadProcessor:
         Returns:
             Dict[str, int]: 處理結果統計
         """
-        logging.info(f"🔍 開始批量處理用戶上傳檔案 (最多 {max_count} 個)...")
+        logging.info("🔍 開始批量處理用戶上傳檔案 (最多 %s 個)...", max_count)
         
-        # 獲取待處理的上傳檔案
-        pending_uploads = self.supabase_service.get_pending_uploads(limit=max_count)
+        # 原子地認領待處理的上傳檔案 (狀態會直接變為 processing)
+        pending_uploads = self.supabase_service.claim_pending_uploads(limit=max_count)
         
         if not pending_uploads:
             logging.info("✅ 沒有待處理的上傳檔案")
@@ -132,15 +136,22 @@ class UploadProcessor:
         
         results = {"total": len(pending_uploads), "success": 0, "failed": 0}
         
-        for upload_record in pending_uploads:
-            success = self.process_single_upload(upload_record)
-            if success:
-                results["success"] += 1
-            else:
-                results["failed"] += 1
+        # 每個檔案的處理時間主要花在等待 PDF 下載、Gemini 與 Supabase 的網路 I/O，
+        # 因此以有上限的執行緒池同時處理多個檔案
+        with ThreadPoolExecutor(max_workers=self.settings.UPLOAD_CONCURRENCY) as executor:
+            futures = [
+                executor.submit(self.process_single_upload, upload_record)
+                for upload_record in pending_uploads
+            ]
+            # process_single_upload 會自行捕捉錯誤並回傳是否成功，因此依完成順序統計即可
+            for future in as_completed(futures):
+                if future.result():
+                    results["success"] += 1
+                else:
+                    results["failed"] += 1
         
-        logging.info(f"📊 批量處理完成: 總共 {results['total']} 個檔案，"
-                    f"成功 {results['success']} 個，失敗 {results['failed']} 個")
+        logging.info("📊 批量處理完成: 總共 %d 個檔案，成功 %d 個，失敗 %d 個",
+                     results['total'], results['success'], results['failed'])
         
         return results
 
@@ -150,18 +161,22 @@ def main():
     setup_logging()
     logging.info("🚀 開始執行用戶上傳論文處理工作流程...")
     
+    processor = None
     try:
         processor = UploadProcessor()
         results = processor.process_pending_uploads(max_count=10)
         
         if results["total"] > 0:
-            logging.info(f"✅ 處理完成！成功率: {results['success']}/{results['total']} "
-                        f"({results['success']/results['total']*100:.1f}%)")
+            logging.info("✅ 處理完成！成功率: %d/%d (%.1f%%)",
+                         results['success'], results['total'], results['success'] / results['total'] * 100)
         else:
             logging.info("✅ 目前沒有待處理的檔案")
             
     except Exception as e:
-        logging.critical(f"😭 工作流程執行失敗: {e}", exc_info=True)
+        logging.critical("😭 工作流程執行失敗: %s", e, exc_info=True)
+    finally:
+        if processor is not None:
+            processor.close()
     
     logging.info("🏁 用戶上傳論文處理工作流程執行完畢")
 
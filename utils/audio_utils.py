@@ -1,23 +1,70 @@
 # -*- coding: utf-8 -*-
 import io
-import wave
+import struct
 import logging
+from typing import Tuple
+
+# 標準 PCM WAV 檔頭 (RIFF + fmt + data chunk)，固定 44 bytes
+WAV_HEADER_FORMAT = '<4sI4s4sIHHIIHH4sI'
 
 def convert_pcm_to_wav_in_memory(pcm_data: bytes, channels: int = 1, sample_width: int = 2, frame_rate: int = 24000) -> bytes:
     """
     將 raw PCM 音訊資料在記憶體中轉換為 WAV 格式。
+    PCM 的 WAV 檔頭是固定格式，直接以 struct 組出檔頭後接上 PCM 資料即可。
     """
     logging.info("🎙️ 正在將音訊資料轉換為 WAV 格式...")
     try:
-        with io.BytesIO() as wav_file:
-            with wave.open(wav_file, 'wb') as wf:
-                wf.setnchannels(channels)
-                wf.setsampwidth(sample_width)
-                wf.setframerate(frame_rate)
-                wf.writeframes(pcm_data)
-            wav_data = wav_file.getvalue()
+        block_align = channels * sample_width
+        header = struct.pack(
+            WAV_HEADER_FORMAT,
+            b'RIFF', 36 + len(pcm_data), b'WAVE',
+            b'fmt ', 16, 1, channels, frame_rate, frame_rate * block_align, block_align, sample_width * 8,
+            b'data', len(pcm_data)
+        )
+        wav_data = header + pcm_data
         logging.info("✅ 音訊已成功轉換為 WAV 格式。")
         return wav_data
     except Exception as e:
-        logging.error(f"音訊轉換為 WAV 時發生錯誤: {e}")
-        raise 
\ No newline at end of file
+        logging.error("音訊轉換為 WAV 時發生錯誤: %s", e)
+        raise
+
+def convert_pcm_to_ogg_opus(pcm_data: bytes, channels: int = 1, sample_width: int = 2, frame_rate: int = 24000, bit_rate: int = 32000) -> bytes:
+    """
+    將 raw PCM 音訊資料在記憶體中編碼為 Ogg/Opus。
+    語音以 32 kbps 的 Opus 編碼，檔案約為 WAV 的十分之一。需要安裝 PyAV (av) 套件。
+    """
+    import av  # 選用套件，只有啟用 Opus 輸出時才需要
+
+    if sample_width != 2:
+        raise ValueError(f"Opus 編碼只支援 16-bit PCM，收到 sample_width={sample_width}")
+
+    buffer = io.BytesIO()
+    with av.open(buffer, mode='w', format='ogg') as container:
+        stream = container.add_stream('libopus', rate=frame_rate)
+        stream.bit_rate = bit_rate
+        stream.layout = 'mono' if channels == 1 else 'stereo'
+
+        # 整段 PCM 放入單一 frame，PyAV 會依編碼器的 frame_size 自動切分
+        frame = av.AudioFrame(format='s16', layout=stream.layout, samples=len(pcm_data) // (channels * sample_width))
+        frame.sample_rate = frame_rate
+        frame.planes[0].update(pcm_data)
+
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return buffer.getvalue()
+
+def encode_pcm_audio(pcm_data: bytes, audio_format: str = "wav") -> Tuple[bytes, str]:
+    """
+    依 audio_format ("wav" 或 "ogg") 將 raw PCM 編碼，回傳 (音檔資料, 副檔名)。
+    Opus 編碼不可用 (未安裝 PyAV 或編碼失敗) 時退回 WAV，不中斷流程。
+    """
+    if audio_format == "ogg":
+        try:
+            ogg_data = convert_pcm_to_ogg_opus(pcm_data)
+            logging.info("✅ 音訊已編碼為 Ogg/Opus，大小: %d bytes", len(ogg_data))
+            return ogg_data, ".ogg"
+        except Exception as e:
+            logging.warning("Opus 編碼失敗 (%s)，改為輸出 WAV", e)
+    return convert_pcm_to_wav_in_memory(pcm_data), ".wav"
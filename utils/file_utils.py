@@ -1,49 +1,76 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
 import logging
+import os
+import re
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import json
 
+from config import get_settings
 from podcast_generater import PaperInfo
 
+# 資料夾名稱只保留文字、數字、空白、連字號與中文標點，其餘字元 (如 / : ?) 一律移除
+_UNSAFE_TITLE_RE = re.compile(r"[^\w \-，。]")
+
+def _safe_title(title: str) -> str:
+    """將論文標題轉為可安全作為資料夾名稱的字串"""
+    return _UNSAFE_TITLE_RE.sub("", title)[:30].strip() or "論文播客"
+
+def _write_all(path: Path, data: bytes):
+    """
+    以低階檔案描述符將資料直接寫入檔案，略過 Python 的 io 緩衝層。
+    os.write 可能只寫入部分資料，因此以 memoryview 切片 (不複製) 迴圈寫到完成為止。
+    """
+    fd = os.open(str(path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
 def save_output_locally(
     output_base_folder: str,
     arxiv_id: str,
     paper_info: PaperInfo,
     script: str,
-    wav_data: bytes
+    audio_data: bytes,
+    audio_ext: str = ".wav"
 ):
     """
     (可選) 將所有生成的檔案儲存到本地資料夾，主要用於本地測試和除錯。
     """
     try:
-        logging.info(f"📁 準備將產出儲存到本地資料夾 (僅供測試)...")
+        logging.info("📁 準備將產出儲存到本地資料夾 (僅供測試)...")
         output_base = Path(output_base_folder)
         # 加上時間戳記
         timestamp = datetime.now().strftime("%Y%m%d_%H%M")
-        paper_folder = output_base / f"{timestamp}_{arxiv_id}_{paper_info.title}"
+        paper_folder = output_base / f"{timestamp}_{arxiv_id}_{_safe_title(paper_info.title)}"
         paper_folder.mkdir(parents=True, exist_ok=True)
-        logging.info(f"   - 本地輸出資料夾: {paper_folder}")
+        logging.info("   - 本地輸出資料夾: %s", paper_folder)
 
-        # 儲存論文資訊
         info_path = paper_folder / f"{arxiv_id}_info.json"
-        with open(info_path, 'w', encoding='utf-8') as f:
-            # 使用 pydantic 的 model_dump_json 來生成漂亮的 JSON
-            f.write(paper_info.model_dump_json(indent=4))
-        logging.info(f"   - 論文資訊已儲存到: {info_path}")
-
-        # 儲存逐字稿
         script_path = paper_folder / f"{arxiv_id}_script.txt"
-        script_path.write_text(script, encoding='utf-8')
-        logging.info(f"   - 逐字稿已儲存到: {script_path}")
+        audio_path = paper_folder / f"{arxiv_id}{audio_ext}"
+        outputs = {
+            # 使用 orjson 直接輸出 UTF-8 bytes，中文不需跳脫；預設為精簡格式，DEBUG 模式才縮排
+            "論文資訊": (info_path, orjson.dumps(
+                paper_info.model_dump(mode='json'),
+                option=orjson.OPT_INDENT_2 if get_settings().DEBUG else None
+            )),
+            "逐字稿": (script_path, script.encode('utf-8')),
+            "音檔": (audio_path, audio_data),
+        }
 
-        # 儲存音檔
-        audio_path = paper_folder / f"{arxiv_id}.wav"
-        with open(audio_path, 'wb') as f:
-            f.write(wav_data)
-        logging.info(f"   - 音檔已儲存到: {audio_path}")
+        # 三個檔案互不相依，以執行緒池同時寫入，讓較小檔案的寫入與數十 MB 的音檔寫入重疊
+        with ThreadPoolExecutor(max_workers=len(outputs)) as executor:
+            futures = {name: executor.submit(_write_all, path, data) for name, (path, data) in outputs.items()}
+            for name, future in futures.items():
+                future.result()
+                logging.info("   - %s已儲存到: %s", name, outputs[name][0])
         
     except Exception as e:
-        logging.error(f"本地儲存檔案時發生錯誤: {e}", exc_info=True)
+        logging.error("本地儲存檔案時發生錯誤: %s", e, exc_info=True)
         # 本地儲存失敗不應中斷主流程
         pass 
\ No newline at end of file